@@ -1,12 +1,22 @@
 import os
-import sqlite3
+import time
+import heapq
+import asyncio
+import functools
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
     filters, ContextTypes, ConversationHandler, CallbackQueryHandler
 )
-from telegram.error import TelegramError
+from telegram.error import TelegramError, BadRequest
+
+from storage import (
+    Storage, SQLiteStorage, MemoryStorage,
+    StorageError, InvalidDiscountCode, DiscountAlreadyUsed
+)
 
 # Load environment variables
 load_dotenv()
@@ -28,7 +38,7 @@ ADMIN_ID = int(os.getenv("ADMIN_TELEGRAM_ID", 0))
     ADMIN_BROADCAST_MESSAGE_INPUT, ADMIN_BROADCAST_CONFIRMATION,
     ADMIN_APPROVE_REJECT_USER_ID, ADMIN_PROCESS_PURCHASE_REQUEST,
     ADMIN_PANEL_STATE # New state for the admin panel
-) = range(26) # Increased range
+) = range(24) # Increased range
 
 # Define constants for navigation callbacks
 ADMIN_MAIN_MENU = "admin_main_menu"
@@ -39,64 +49,294 @@ ADMIN_MESSAGE_MGMT_MENU = "admin_message_mgmt_menu"
 ADMIN_STATS_MENU = "admin_stats_menu"
 ADMIN_PURCHASE_REQ_MENU = "admin_purchase_req_menu"
 
-# Connect to database
-conn = sqlite3.connect("users.db", check_same_thread=False)
-cursor = conn.cursor()
-
-# --- Database Setup ---
-def setup_database():
-    # Create users table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        username TEXT,
-        credit INTEGER DEFAULT 0,
-        discount_used INTEGER DEFAULT 0,
-        is_approved INTEGER DEFAULT 0,
-        phone_number TEXT,
-        full_name TEXT,
-        device_type TEXT
-    )
-    """)
-    # Create codes table for discount codes
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS codes (
-        code TEXT PRIMARY KEY,
-        value INTEGER
-    )
-    """)
-    # Create services table with price
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS services (
-        type TEXT PRIMARY KEY,
-        content TEXT,
-        is_file INTEGER DEFAULT 0,
-        price INTEGER DEFAULT 0
-    )
-    """)
-    # Create support messages table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS support_messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        message TEXT,
-        timestamp TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-    # Create purchase requests table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS purchase_requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount INTEGER,
-        description TEXT,
-        timestamp TEXT,
-        status TEXT DEFAULT 'pending',
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    """)
-    conn.commit()
+# Number of (chat_id, message_id) entries kept in the render cache
+RENDER_CACHE_SIZE = 2048
+
+# Idempotency settings for money-moving actions
+PROCESSED_UPDATES_SIZE = 10000
+PROCESSED_UPDATES_TTL = 3600 # Seconds a processed update/callback id is remembered
+DOUBLE_TAP_WINDOW = 10 # Seconds in which the same button tap on the same message is ignored
+
+# Subscription settings
+SUBSCRIPTION_REMINDER_SECONDS = 3 * 24 * 3600 # Remind users 3 days before expiry
+
+# Storage backend: "sqlite" (default) or "memory"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DATABASE_PATH = os.getenv("DATABASE_PATH", "users.db")
+
+# --- Storage ---
+
+def create_storage() -> Storage:
+    if STORAGE_BACKEND == "memory":
+        return MemoryStorage()
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(DATABASE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+def get_storage(context: ContextTypes.DEFAULT_TYPE) -> Storage:
+    return context.bot_data["storage"]
+
+# --- Message Rendering ---
+
+# Simple in-process counters (render cache hits/misses, ...)
+metrics = Counter()
+
+# (chat_id, message_id) -> hash of the last text/markup we rendered, least recently used first
+render_cache = OrderedDict()
+
+def _render_hash(text: str, reply_markup, parse_mode) -> int:
+    markup_json = reply_markup.to_json() if reply_markup is not None else None
+    return hash((text, markup_json, parse_mode))
+
+async def edit_message(message, text: str, reply_markup=None, parse_mode=None):
+    """Edit a message, skipping the API call when it already shows the same text and markup."""
+    key = (message.chat_id, message.message_id)
+    rendered = _render_hash(text, reply_markup, parse_mode)
+    if render_cache.get(key) == rendered:
+        render_cache.move_to_end(key)
+        metrics["render_cache_hits"] += 1
+        return None
+
+    metrics["render_cache_misses"] += 1
+    try:
+        result = await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+        result = None
+
+    render_cache[key] = rendered
+    render_cache.move_to_end(key)
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        render_cache.popitem(last=False)
+    return result
+
+# --- Concurrency Guards ---
+
+class UserLockRegistry:
+    """Per-user asyncio locks. A user's lock is dropped as soon as nobody holds or waits on it."""
+
+    def __init__(self):
+        self._locks = {} # user_id -> [asyncio.Lock, number of holders/waiters]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+class IdempotencyCache:
+    """Bounded set of recently seen keys that expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._seen = OrderedDict() # key -> expiry, oldest first
+
+    def seen(self, key) -> bool:
+        """Return True if `key` was already recorded; otherwise record it and return False."""
+        now = time.monotonic()
+        expires = self._seen.get(key)
+        if expires is not None and expires > now:
+            return True
+        self._seen[key] = now + self.ttl
+        self._seen.move_to_end(key)
+        # Entries share one ttl, so the front of the dict is always the next to expire
+        while self._seen and (len(self._seen) > self.maxsize or next(iter(self._seen.values())) <= now):
+            self._seen.popitem(last=False)
+        return False
+
+    def discard(self, key) -> None:
+        self._seen.pop(key, None)
+
+user_locks = UserLockRegistry()
+processed_updates = IdempotencyCache(PROCESSED_UPDATES_SIZE, PROCESSED_UPDATES_TTL)
+recent_taps = IdempotencyCache(PROCESSED_UPDATES_SIZE, DOUBLE_TAP_WINDOW)
+
+def money_action(handler):
+    """Run a handler that moves credit or creates requests at most once per update, one at a time per user.
+
+    Duplicate deliveries of the same update (or callback query) are dropped before taking the lock.
+    Use this for the transfer, top-up and purchase handlers as well once they are added.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+
+        if update.callback_query is not None:
+            key = ("callback", update.callback_query.id)
+        else:
+            key = ("update", update.update_id)
+        if processed_updates.seen(key):
+            metrics["duplicate_updates_dropped"] += 1
+            return None # Keep the conversation in its current state
+
+        async with user_locks.hold(user.id):
+            try:
+                return await handler(update, context)
+            except Exception:
+                processed_updates.discard(key) # Let a retry of a failed update through
+                raise
+    return wrapper
+
+# --- Subscriptions ---
+
+def format_remaining(seconds: int) -> str:
+    if seconds <= 0:
+        return "منقضی شده"
+    days, rest = divmod(int(seconds), 24 * 3600)
+    hours, rest = divmod(rest, 3600)
+    if days:
+        return f"{days} روز و {hours} ساعت"
+    return f"{hours} ساعت و {rest // 60} دقیقه"
+
+class ExpiryScheduler:
+    """Min-heap of upcoming subscription events (reminders and expiries).
+
+    Each heap entry is (due_at, kind, subscription_id, expires_at). Entries are never
+    removed in place; when a subscription is renewed a new entry is pushed and the old
+    one is recognised as stale (its expires_at no longer matches the database) when popped.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._wakeup = None
+        self._task = None
+        self._storage = None
+
+    def schedule(self, subscription_id: int, expires_at: int, reminder_sent: int = 0) -> None:
+        """Schedule a new or renewed subscription."""
+        for entry in self._entries(subscription_id, expires_at, reminder_sent, catch_up=False):
+            self._push(*entry)
+
+    @staticmethod
+    def _entries(subscription_id: int, expires_at: int, reminder_sent: int, catch_up: bool) -> list:
+        """Heap entries for a subscription.
+
+        A reminder whose time has already passed is only kept with `catch_up` (i.e. it was missed
+        while the bot was offline); for a new subscription it means the subscription is shorter
+        than the reminder window, so no reminder is sent.
+        """
+        now = time.time()
+        remind_at = expires_at - SUBSCRIPTION_REMINDER_SECONDS
+        entries = []
+        if not reminder_sent and remind_at < expires_at and (remind_at > now or (catch_up and expires_at > now)):
+            entries.append((remind_at, "remind", subscription_id, expires_at))
+        entries.append((expires_at, "expire", subscription_id, expires_at))
+        return entries
+
+    def _push(self, due_at: int, kind: str, subscription_id: int, expires_at: int) -> None:
+        entry = (due_at, kind, subscription_id, expires_at)
+        heapq.heappush(self._heap, entry)
+        # Only wake the loop if the new entry is now the earliest one
+        if self._heap[0] is entry and self._wakeup is not None:
+            self._wakeup.set()
+
+    def load(self, storage: Storage) -> None:
+        """Rebuild the heap from active subscriptions (served by idx_subscriptions_status_expiry)."""
+        self._heap = []
+        for subscription in storage.list_active_subscriptions():
+            self._heap.extend(self._entries(
+                subscription["id"], subscription["expires_at"], subscription["reminder_sent"], catch_up=True
+            ))
+        heapq.heapify(self._heap)
+
+    def start(self, bot, storage: Storage) -> None:
+        self._storage = storage
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot) -> None:
+        while True:
+            while self._heap and self._heap[0][0] <= time.time():
+                _, kind, subscription_id, expires_at = heapq.heappop(self._heap)
+                try:
+                    await self._fire(bot, kind, subscription_id, expires_at)
+                except Exception as e:
+                    print(f"Error while processing subscription {subscription_id} ({kind}): {e}")
+            # Sending messages above takes time, so measure the wait from the current time
+            timeout = max(0, self._heap[0][0] - time.time()) if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, bot, kind: str, subscription_id: int, expires_at: int) -> None:
+        subscription = self._storage.get_subscription(subscription_id)
+        if not subscription:
+            return
+        user_id, service_type = subscription["user_id"], subscription["service_type"]
+        if subscription["status"] != 'active' or subscription["expires_at"] != expires_at:
+            return # Stale entry: subscription was renewed or already closed
+
+        if kind == "remind":
+            if subscription["reminder_sent"]:
+                return
+            self._storage.update_subscription(subscription_id, reminder_sent=1)
+            try:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=f"⏳ اشتراک {service_type} شما {format_remaining(expires_at - time.time())} دیگر منقضی می‌شود.\n"
+                         "برای تمدید با پشتیبانی تماس بگیرید."
+                )
+            except TelegramError:
+                pass # User might have blocked the bot
+        elif kind == "expire":
+            self._storage.update_subscription(subscription_id, status='expired')
+            try:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=f"⌛️ اشتراک {service_type} شما به پایان رسید. برای تمدید با پشتیبانی تماس بگیرید."
+                )
+            except TelegramError:
+                pass # User might have blocked the bot
+            await bot.send_message(
+                ADMIN_ID,
+                f"⌛️ اشتراک {service_type} کاربر با ID `{user_id}` منقضی شد.",
+                parse_mode='Markdown'
+            )
+
+expiry_scheduler = ExpiryScheduler()
+
+def add_or_renew_subscription(storage: Storage, user_id: int, service_type: str, days: int, quota=None) -> int:
+    """Create a subscription, or extend the user's active one for the same service. Returns the new expiry."""
+    now = int(time.time())
+    subscription = storage.get_active_subscription(user_id, service_type)
+    if subscription:
+        subscription_id = subscription["id"]
+        expires_at = max(now, subscription["expires_at"]) + days * 24 * 3600
+        fields = {"expires_at": expires_at, "reminder_sent": 0}
+        if quota is not None:
+            fields["quota"] = quota
+        storage.update_subscription(subscription_id, **fields)
+    else:
+        expires_at = now + days * 24 * 3600
+        subscription_id = storage.add_subscription(user_id, service_type, now, expires_at, quota)
+    expiry_scheduler.schedule(subscription_id, expires_at)
+    return expires_at
 
 # --- Inline Keyboards ---
 
@@ -181,15 +421,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     await update.message.reply_text("خوش آمدید.", reply_markup=ReplyKeyboardRemove())
 
-    cursor.execute("SELECT full_name FROM users WHERE id=?", (user.id,))
-    user_info = cursor.fetchone()
+    storage = get_storage(context)
+    user_info = storage.get_user(user.id)
 
-    if not user_info or user_info[0] is None:
-        cursor.execute(
-            "INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)",
-            (user.id, user.username)
-        )
-        conn.commit()
+    if not user_info or user_info["full_name"] is None:
+        storage.add_user(user.id, user.username)
         return await ask_phone_number(update, context)
 
     await update.message.reply_text(
@@ -218,10 +454,9 @@ async def score(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user is None or update.message is None:
         return
 
-    cursor.execute("SELECT credit FROM users WHERE id=?", (update.effective_user.id,))
-    user_credit = cursor.fetchone()
-    if user_credit:
-        await update.message.reply_text(f"🔢 امتیاز (اعتبار) شما: {user_credit[0]} تومان")
+    user_data = get_storage(context).get_user(update.effective_user.id)
+    if user_data:
+        await update.message.reply_text(f"🔢 امتیاز (اعتبار) شما: {user_data['credit']} تومان")
     else:
         await update.message.reply_text("❌ اطلاعات شما یافت نشد. لطفاً /start را بزنید.")
 
@@ -231,14 +466,24 @@ async def myinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user is None or message_to_edit is None:
         return
 
-    cursor.execute(
-        "SELECT credit, discount_used, is_approved, phone_number, full_name, device_type FROM users WHERE id=?",
-        (user.id,)
-    )
-    user_data = cursor.fetchone()
+    storage = get_storage(context)
+    user_data = storage.get_user(user.id)
 
     if user_data:
-        credit, discount_used, approved, phone_number, full_name, device_type = user_data
+        credit, discount_used, approved, phone_number, full_name, device_type = (
+            user_data[field] for field in
+            ("credit", "discount_used", "is_approved", "phone_number", "full_name", "device_type")
+        )
+        subscriptions = storage.list_active_subscriptions(user.id)
+        if subscriptions:
+            now = time.time()
+            subscriptions_text = "\n".join(
+                f"🛰 {sub['service_type']}: {format_remaining(sub['expires_at'] - now)} باقی‌مانده"
+                + (f" ({sub['quota']} گیگابایت)" if sub['quota'] else "")
+                for sub in subscriptions
+            )
+        else:
+            subscriptions_text = "🛰 اشتراک فعال: ندارد"
         response_text = f"""👤 @{user.username or 'نامشخص'}
 🆔 `{user.id}`
 📝 نام: {full_name or 'نامشخص'}
@@ -247,16 +492,17 @@ async def myinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 💳 اعتبار: {credit} تومان
 🎁 کد تخفیف: {"استفاده شده" if discount_used else "استفاده نشده"}
 ✅ وضعیت: {"تأیید شده" if approved else "در انتظار تأیید"}
+{subscriptions_text}
 """
         reply_markup = get_main_inline_keyboard(user.id)
         if update.callback_query:
-            await message_to_edit.edit_text(response_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await edit_message(message_to_edit, response_text, reply_markup=reply_markup, parse_mode='Markdown')
         else:
             await message_to_edit.reply_text(response_text, reply_markup=reply_markup, parse_mode='Markdown')
     else:
         error_text = "❌ کاربر یافت نشد. لطفاً دوباره /start را بزنید."
         if update.callback_query:
-            await message_to_edit.edit_text(error_text)
+            await edit_message(message_to_edit, error_text)
         else:
             await message_to_edit.reply_text(error_text)
 
@@ -270,7 +516,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         text = "عملیات لغو شد."
         reply_markup = get_main_inline_keyboard(user.id)
         if update.callback_query:
-            await message_to_edit.edit_text(text, reply_markup=reply_markup)
+            await edit_message(message_to_edit, text, reply_markup=reply_markup)
         else:
             await message_to_edit.reply_text(text, reply_markup=reply_markup)
     return ConversationHandler.END
@@ -310,8 +556,7 @@ async def register_phone_number(update: Update, context: ContextTypes.DEFAULT_TY
             return REGISTER_PHONE
 
     if phone_number:
-        cursor.execute("UPDATE users SET phone_number=? WHERE id=?", (phone_number, user_id))
-        conn.commit()
+        get_storage(context).update_user(user_id, phone_number=phone_number)
         await update.message.reply_text(
             "شماره تلفن شما ثبت شد. حالا لطفاً نام و نام خانوادگی خود را وارد کنید:",
             reply_markup=ReplyKeyboardRemove()
@@ -327,8 +572,7 @@ async def register_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
     user_id = update.effective_user.id
     full_name = update.message.text.strip()
-    cursor.execute("UPDATE users SET full_name=? WHERE id=?", (full_name, user_id))
-    conn.commit()
+    get_storage(context).update_user(user_id, full_name=full_name)
 
     device_keyboard = [
         [InlineKeyboardButton("📱 اندروید", callback_data="register_device_android")],
@@ -357,17 +601,13 @@ async def register_device(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     if device_type:
         # User is set to NOT approved by default. Admin must approve.
-        cursor.execute(
-            "UPDATE users SET device_type=?, is_approved=0 WHERE id=?",
-            (device_type, user.id)
-        )
-        conn.commit()
+        storage = get_storage(context)
+        storage.update_user(user.id, device_type=device_type, is_approved=0)
 
         # Admin notification with approve/reject buttons
-        cursor.execute("SELECT phone_number, full_name FROM users WHERE id=?", (user.id,))
-        registered_user = cursor.fetchone()
+        registered_user = storage.get_user(user.id)
         if registered_user:
-            phone_number, full_name = registered_user
+            phone_number, full_name = registered_user["phone_number"], registered_user["full_name"]
             admin_message = f"""🎉 کاربر جدید ثبت‌نام کرد و در انتظار تأیید است:
 نام: {full_name or 'نامشخص'}
 نام کاربری: @{user.username or 'نامشخص'}
@@ -388,7 +628,8 @@ ID: `{user.id}`
                 parse_mode='Markdown'
             )
 
-        await query.message.edit_text(
+        await edit_message(
+            query.message,
             f"ثبت‌نام شما با موفقیت انجام شد ({device_type}).\n"
             "درخواست شما برای ادمین ارسال شد. پس از تأیید، می‌توانید از امکانات ربات استفاده کنید.",
             reply_markup=get_main_inline_keyboard(user.id)
@@ -410,36 +651,35 @@ async def main_callback_handler(update: Update, context: ContextTypes.DEFAULT_TY
     message_obj = query.message
 
     # Check if user is approved for certain actions
-    cursor.execute("SELECT is_approved FROM users WHERE id=?", (user_id,))
-    user_status = cursor.fetchone()
-    is_approved = user_status and user_status[0] == 1
+    user_data = get_storage(context).get_user(user_id)
+    is_approved = user_data and user_data["is_approved"] == 1
 
     if data in ["get_service", "transfer_credit", "topup"] and not is_approved and user_id != ADMIN_ID:
-        await message_obj.edit_text(
+        await edit_message(
+            message_obj,
             "⛔ حساب شما هنوز توسط ادمین تأیید نشده است. لطفاً منتظر بمانید.",
             reply_markup=get_main_inline_keyboard(user_id)
         )
         return ConversationHandler.END
 
     if data == "main_menu":
-        await message_obj.edit_text("منوی اصلی:", reply_markup=get_main_inline_keyboard(user_id))
+        await edit_message(message_obj, "منوی اصلی:", reply_markup=get_main_inline_keyboard(user_id))
         return ConversationHandler.END
     elif data == "get_app":
         await get_app(update, context)
         return ConversationHandler.END
     elif data == "activate_discount":
-        await message_obj.edit_text("🎁 لطفاً کد تخفیف را وارد کنید:")
+        await edit_message(message_obj, "🎁 لطفاً کد تخفیف را وارد کنید:")
         return ASK_DISCOUNT
     elif data == "my_credit":
-        cursor.execute("SELECT credit FROM users WHERE id=?", (user_id,))
-        credit_result = cursor.fetchone()
-        await message_obj.edit_text(
-            f"💳 اعتبار شما: {credit_result[0] if credit_result else 0} تومان",
+        await edit_message(
+            message_obj,
+            f"💳 اعتبار شما: {user_data['credit'] if user_data else 0} تومان",
             reply_markup=get_main_inline_keyboard(user_id)
         )
         return ConversationHandler.END
     elif data == "transfer_credit":
-        await message_obj.edit_text("🔁 لطفاً ID عددی دریافت‌کننده را وارد کنید:")
+        await edit_message(message_obj, "🔁 لطفاً ID عددی دریافت‌کننده را وارد کنید:")
         return ASK_TARGET
     elif data == "my_status":
         await myinfo(update, context)
@@ -448,10 +688,10 @@ async def main_callback_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await get_service(update, context)
         return ConversationHandler.END
     elif data == "topup":
-        await message_obj.edit_text("💳 مقدار و توضیحات پرداخت خود را وارد کنید:\nمثال: 100000 - کارت به کارت")
+        await edit_message(message_obj, "💳 مقدار و توضیحات پرداخت خود را وارد کنید:\nمثال: 100000 - کارت به کارت")
         return ASK_TOPUP
     elif data == "support_message":
-        await message_obj.edit_text("✉️ لطفاً پیام خود را برای پشتیبانی ارسال کنید:")
+        await edit_message(message_obj, "✉️ لطفاً پیام خود را برای پشتیبانی ارسال کنید:")
         return SUPPORT_MESSAGE
     
     # The 'admin_panel' callback is handled by a separate ConversationHandler
@@ -477,7 +717,8 @@ async def get_app(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         ],
         [InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="main_menu")]
     ]
-    await query.message.edit_text(
+    await edit_message(
+        query.message,
         "لطفاً دستگاه خود را انتخاب کنید:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -499,7 +740,7 @@ async def send_app_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     }
 
     if selected_option in links:
-        await message_obj.edit_text(links[selected_option])
+        await edit_message(message_obj, links[selected_option])
     # The photo guide part can be added here if needed, similar to the original code.
     
     await context.bot.send_message(
@@ -514,11 +755,11 @@ async def get_service(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     await query.answer()
     
-    cursor.execute("SELECT type, price FROM services")
-    services = cursor.fetchall()
+    services = get_storage(context).list_services()
     keyboard = []
     if services:
-        for service_type, price in services:
+        for service in services:
+            service_type, price = service["type"], service["price"]
             price_text = f" ({price:,} تومان)" if price > 0 else ""
             keyboard.append([
                 InlineKeyboardButton(
@@ -530,8 +771,9 @@ async def get_service(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         keyboard.append([InlineKeyboardButton("سرویسی برای ارائه موجود نیست", callback_data="no_service")])
     
     keyboard.append([InlineKeyboardButton("بازگشت به منوی اصلی", callback_data="main_menu")])
-    await query.message.edit_text("کدام سرویس را می‌خواهید؟", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_message(query.message, "کدام سرویس را می‌خواهید؟", reply_markup=InlineKeyboardMarkup(keyboard))
 
+@money_action
 async def send_service_request_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     if query is None or query.from_user is None or query.data is None or query.message is None:
@@ -539,6 +781,11 @@ async def send_service_request_to_admin(update: Update, context: ContextTypes.DE
     
     await query.answer()
     user = query.from_user
+    # A double tap sends two callback queries with different ids for the same button
+    tap_key = (user.id, query.message.message_id, query.data)
+    if recent_taps.seen(tap_key):
+        metrics["duplicate_taps_dropped"] += 1
+        return
     service_key = query.data.replace("request_service_", "")
 
     msg_for_admin = (f"🌐 درخواست سرویس جدید از:\n"
@@ -547,10 +794,15 @@ async def send_service_request_to_admin(update: Update, context: ContextTypes.DE
                      f"سرویس: {service_key}")
     
     # This part can be enhanced to handle service delivery automatically or manually
-    await context.bot.send_message(chat_id=ADMIN_ID, text=msg_for_admin, parse_mode='Markdown')
-    await query.message.edit_text("✅ درخواست شما به ادمین ارسال شد. لطفاً منتظر بمانید.")
+    try:
+        await context.bot.send_message(chat_id=ADMIN_ID, text=msg_for_admin, parse_mode='Markdown')
+    except Exception:
+        recent_taps.discard(tap_key) # The request never reached the admin, so allow a retry
+        raise
+    await edit_message(query.message, "✅ درخواست شما به ادمین ارسال شد. لطفاً منتظر بمانید.")
 
 # --- Discount related functions ---
+@money_action
 async def apply_discount(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.effective_user is None or update.message is None or update.message.text is None:
         return ConversationHandler.END
@@ -558,33 +810,29 @@ async def apply_discount(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     code = update.message.text.strip()
 
-    cursor.execute("SELECT discount_used FROM users WHERE id=?", (user_id,))
-    user_data = cursor.fetchone()
+    storage = get_storage(context)
+    user_data = storage.get_user(user_id)
 
-    if user_data and user_data[0]:
+    if user_data and user_data["discount_used"]:
         await update.message.reply_text("⛔ شما قبلاً از کد تخفیف استفاده کرده‌اید.")
         return ConversationHandler.END
 
-    cursor.execute("SELECT value FROM codes WHERE code=?", (code,))
-    row = cursor.fetchone()
-    if row:
-        value = row[0]
-        try:
-            # Use a transaction for atomicity
-            cursor.execute("UPDATE users SET credit = credit + ?, discount_used = 1 WHERE id=?", (value, user_id))
-            cursor.execute("DELETE FROM codes WHERE code=?", (code,))
-            conn.commit()
-            await update.message.reply_text(f"✅ تبریک! مبلغ {value} تومان به اعتبار شما اضافه شد.")
-            await context.bot.send_message(
-                ADMIN_ID,
-                f"کاربر با ID `{user_id}` کد تخفیف `{code}` را با موفقیت استفاده کرد."
-            )
-        except sqlite3.Error as e:
-            conn.rollback()
-            await update.message.reply_text("خطایی در سیستم رخ داد. لطفاً بعداً تلاش کنید.")
-            print(f"Database error during discount application: {e}")
-    else:
+    try:
+        # Consumes the code and credits the user atomically, at most once
+        value = storage.redeem_discount_code(user_id, code)
+    except InvalidDiscountCode:
         await update.message.reply_text("❌ کد تخفیف وارد شده معتبر نیست.")
+    except DiscountAlreadyUsed:
+        await update.message.reply_text("⛔ شما قبلاً از کد تخفیف استفاده کرده‌اید.")
+    except StorageError as e:
+        await update.message.reply_text("خطایی در سیستم رخ داد. لطفاً بعداً تلاش کنید.")
+        print(f"Database error during discount application: {e}")
+    else:
+        await update.message.reply_text(f"✅ تبریک! مبلغ {value} تومان به اعتبار شما اضافه شد.")
+        await context.bot.send_message(
+            ADMIN_ID,
+            f"کاربر با ID `{user_id}` کد تخفیف `{code}` را با موفقیت استفاده کرد."
+        )
 
     await update.message.reply_text("منوی اصلی:", reply_markup=get_main_inline_keyboard(user_id))
     return ConversationHandler.END
@@ -597,7 +845,8 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
     
     await query.answer()
-    await query.message.edit_text(
+    await edit_message(
+        query.message,
         "🎛 به پنل مدیریت خوش آمدید.",
         reply_markup=get_admin_main_inline_keyboard()
     )
@@ -613,15 +862,15 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     message_obj = query.message
 
     if data == ADMIN_USER_MGMT_MENU:
-        await message_obj.edit_text("👥 مدیریت کاربران:", reply_markup=get_admin_user_mgmt_keyboard())
+        await edit_message(message_obj, "👥 مدیریت کاربران:", reply_markup=get_admin_user_mgmt_keyboard())
     elif data == ADMIN_SERVICE_MGMT_MENU:
-        await message_obj.edit_text("🛰 مدیریت سرویس‌ها:", reply_markup=get_admin_service_mgmt_keyboard())
+        await edit_message(message_obj, "🛰 مدیریت سرویس‌ها:", reply_markup=get_admin_service_mgmt_keyboard())
     elif data == ADMIN_DISCOUNT_MGMT_MENU:
-        await message_obj.edit_text("🎁 مدیریت کدهای تخفیف:", reply_markup=get_admin_discount_mgmt_keyboard())
+        await edit_message(message_obj, "🎁 مدیریت کدهای تخفیف:", reply_markup=get_admin_discount_mgmt_keyboard())
     elif data == ADMIN_MESSAGE_MGMT_MENU:
-        await message_obj.edit_text("📢 مدیریت پیام‌ها:", reply_markup=get_admin_message_mgmt_keyboard())
+        await edit_message(message_obj, "📢 مدیریت پیام‌ها:", reply_markup=get_admin_message_mgmt_keyboard())
     elif data == "admin_panel": # Back to admin main menu
-        await message_obj.edit_text("🎛 پنل مدیریت:", reply_markup=get_admin_main_inline_keyboard())
+        await edit_message(message_obj, "🎛 پنل مدیریت:", reply_markup=get_admin_main_inline_keyboard())
     # Add handlers for other admin menus (stats, purchase reqs, etc.) here
     
     return ADMIN_PANEL_STATE
@@ -638,9 +887,8 @@ async def admin_process_approval(update: Update, context: ContextTypes.DEFAULT_T
     user_id_to_process = int(data_parts[2])
 
     if action == "approve":
-        cursor.execute("UPDATE users SET is_approved=1 WHERE id=?", (user_id_to_process,))
-        conn.commit()
-        await query.message.edit_text(f"✅ کاربر با ID `{user_id_to_process}` با موفقیت تأیید شد.")
+        get_storage(context).update_user(user_id_to_process, is_approved=1)
+        await edit_message(query.message, f"✅ کاربر با ID `{user_id_to_process}` با موفقیت تأیید شد.")
         try:
             await context.bot.send_message(
                 chat_id=user_id_to_process,
@@ -652,7 +900,7 @@ async def admin_process_approval(update: Update, context: ContextTypes.DEFAULT_T
     elif action == "reject":
         # You might want to delete the user or just leave them as not approved
         # For now, we just notify the admin.
-        await query.message.edit_text(f"❌ درخواست کاربر با ID `{user_id_to_process}` رد شد.")
+        await edit_message(query.message, f"❌ درخواست کاربر با ID `{user_id_to_process}` رد شد.")
         try:
             await context.bot.send_message(
                 chat_id=user_id_to_process,
@@ -661,16 +909,71 @@ async def admin_process_approval(update: Update, context: ContextTypes.DEFAULT_T
         except TelegramError:
             pass # User might have blocked the bot
 
+@money_action
+async def admin_add_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/addsub <user_id> <service_type> <days> [quota_gb]"""
+    if update.effective_user is None or update.message is None or update.effective_user.id != ADMIN_ID:
+        return
+
+    args = context.args or []
+    if len(args) not in (3, 4):
+        await update.message.reply_text("استفاده: /addsub <user_id> <service_type> <days> [quota_gb]")
+        return
+    try:
+        user_id = int(args[0])
+        days = int(args[2])
+        quota = int(args[3]) if len(args) == 4 else None
+    except ValueError:
+        await update.message.reply_text("❌ مقادیر وارد شده معتبر نیست.")
+        return
+    if days <= 0 or (quota is not None and quota < 0):
+        await update.message.reply_text("❌ مقادیر وارد شده معتبر نیست.")
+        return
+    service_type = args[1]
+
+    storage = get_storage(context)
+    if storage.get_user(user_id) is None:
+        await update.message.reply_text("❌ کاربر یافت نشد.")
+        return
+    if storage.get_service(service_type) is None:
+        await update.message.reply_text("❌ سرویس یافت نشد.")
+        return
+
+    expires_at = add_or_renew_subscription(storage, user_id, service_type, days, quota)
+    remaining = format_remaining(expires_at - time.time())
+    await update.message.reply_text(f"✅ اشتراک {service_type} برای کاربر `{user_id}` ثبت شد ({remaining} باقی‌مانده).", parse_mode='Markdown')
+    try:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"🎉 اشتراک {service_type} شما فعال شد. زمان باقی‌مانده: {remaining}"
+        )
+    except TelegramError as e:
+        await update.message.reply_text(f"⚠️ کاربر را مسدود کرده یا ربات را ترک کرده است. ({e})")
+
 # --- Main Function ---
+async def post_init(application: Application) -> None:
+    storage = application.bot_data["storage"]
+    expiry_scheduler.load(storage)
+    expiry_scheduler.start(application.bot, storage)
+
+async def post_shutdown(application: Application) -> None:
+    await expiry_scheduler.stop()
+    application.bot_data["storage"].close()
+
 def main() -> None:
     """Start the bot."""
     if not TOKEN:
         raise ValueError("No TELEGRAM_BOT_TOKEN found in environment variables")
-        
-    # First, setup the database
-    setup_database()
 
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    # Handlers reach the database through context.bot_data; the SQLite connection opens on first use
+    application.bot_data["storage"] = create_storage()
 
     # Conversation handler for registration
     register_conv = ConversationHandler(
@@ -688,7 +991,7 @@ def main() -> None:
         entry_points=[CallbackQueryHandler(main_callback_handler)],
         states={
             ASK_DISCOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, apply_discount)],
-            # Add other states like ASK_TARGET, ASK_AMOUNT, ASK_TOPUP here
+            # Add other states like ASK_TARGET, ASK_AMOUNT, ASK_TOPUP here (wrap their handlers with @money_action)
         },
         fallbacks=[CommandHandler("cancel", cancel), CallbackQueryHandler(cancel, pattern="^cancel_")],
         map_to_parent={
@@ -714,6 +1017,7 @@ def main() -> None:
     application.add_handler(CommandHandler("about", about))
     application.add_handler(CommandHandler("score", score))
     application.add_handler(CommandHandler("myinfo", myinfo))
+    application.add_handler(CommandHandler("addsub", admin_add_subscription))
     
     # Handler for app links
     application.add_handler(CallbackQueryHandler(send_app_link, pattern="^app_"))
@@ -0,0 +1,538 @@
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Optional
+
+USER_FIELDS = ("id", "username", "credit", "discount_used", "is_approved", "phone_number", "full_name", "device_type")
+SUBSCRIPTION_FIELDS = ("id", "user_id", "service_type", "started_at", "expires_at", "quota", "reminder_sent", "status")
+
+
+class StorageError(Exception):
+    """Raised when the backend fails to read or write data."""
+
+
+class InvalidDiscountCode(Exception):
+    """Raised when a discount code does not exist or was already consumed."""
+
+
+class DiscountAlreadyUsed(Exception):
+    """Raised when a user who already used a discount tries to redeem another code."""
+
+
+class Storage(ABC):
+    """Interface for everything the bot persists.
+
+    Rows are returned as plain dicts keyed by column name. Handlers get the active
+    backend from `context.bot_data["storage"]`.
+    """
+
+    def close(self) -> None:
+        pass
+
+    # --- users ---
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_user(self, user_id: int, username: Optional[str]) -> None:
+        """Insert a user if it does not exist yet."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, user_id: int, **fields) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_users(self, is_approved: Optional[int] = None) -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    def change_credit(self, user_id: int, amount: int) -> bool:
+        """Add `amount` (may be negative) to a user's credit. Returns False if the user does not exist."""
+        raise NotImplementedError
+
+    # --- codes ---
+    @abstractmethod
+    def get_code_value(self, code: str) -> Optional[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_code(self, code: str, value: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_code(self, code: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def redeem_discount_code(self, user_id: int, code: str) -> int:
+        """Atomically consume `code` and credit its value to a user who has not used a discount yet.
+
+        Returns the credited value. Raises InvalidDiscountCode if the code does not exist (or was just
+        consumed by another request) and DiscountAlreadyUsed if the user already used a discount.
+        """
+        raise NotImplementedError
+
+    # --- services ---
+    @abstractmethod
+    def list_services(self) -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_service(self, service_type: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_service(self, service_type: str, content: Optional[str] = None, is_file: int = 0, price: int = 0) -> None:
+        raise NotImplementedError
+
+    # --- support_messages ---
+    @abstractmethod
+    def add_support_message(self, user_id: int, message: str, timestamp: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_support_messages(self) -> list:
+        raise NotImplementedError
+
+    # --- purchase_requests ---
+    @abstractmethod
+    def add_purchase_request(self, user_id: int, amount: int, description: str, timestamp: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_purchase_requests(self, status: Optional[str] = "pending") -> list:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_purchase_request_status(self, request_id: int, status: str) -> bool:
+        raise NotImplementedError
+
+    # --- subscriptions ---
+    @abstractmethod
+    def get_subscription(self, subscription_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_active_subscription(self, user_id: int, service_type: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_subscription(self, user_id: int, service_type: str, started_at: int, expires_at: int, quota: Optional[int]) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_subscription(self, subscription_id: int, **fields) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_active_subscriptions(self, user_id: Optional[int] = None) -> list:
+        """Active subscriptions ordered by expiry, optionally for a single user."""
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    """SQLite backend. The connection is opened (and the schema created) on first use."""
+
+    def __init__(self, path: str = "users.db"):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = None
+            try:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                self._setup_database(conn)
+            except sqlite3.Error as e:
+                if conn is not None:
+                    conn.close()
+                raise StorageError(str(e)) from e
+            # Only keep the connection once the schema exists, so a failed setup is retried
+            self._conn = conn
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _setup_database(self, conn: sqlite3.Connection) -> None:
+        cursor = conn.cursor()
+        # Create users table
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            credit INTEGER DEFAULT 0,
+            discount_used INTEGER DEFAULT 0,
+            is_approved INTEGER DEFAULT 0,
+            phone_number TEXT,
+            full_name TEXT,
+            device_type TEXT
+        )
+        """)
+        # Create codes table for discount codes
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS codes (
+            code TEXT PRIMARY KEY,
+            value INTEGER
+        )
+        """)
+        # Create services table with price
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS services (
+            type TEXT PRIMARY KEY,
+            content TEXT,
+            is_file INTEGER DEFAULT 0,
+            price INTEGER DEFAULT 0
+        )
+        """)
+        # Create support messages table
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS support_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message TEXT,
+            timestamp TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """)
+        # Create purchase requests table
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS purchase_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            description TEXT,
+            timestamp TEXT,
+            status TEXT DEFAULT 'pending',
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """)
+        # Create subscriptions table (timestamps are unix seconds, quota in GB, NULL = unlimited)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            service_type TEXT,
+            started_at INTEGER,
+            expires_at INTEGER,
+            quota INTEGER,
+            reminder_sent INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'active',
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(service_type) REFERENCES services(type)
+        )
+        """)
+        # Index used to rebuild the expiry scheduler at startup without scanning all rows
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_status_expiry ON subscriptions (status, expires_at)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions (user_id, status)"
+        )
+        conn.commit()
+
+    def _execute(self, sql: str, params=(), commit: bool = True) -> sqlite3.Cursor:
+        conn = self.conn
+        try:
+            cursor = conn.execute(sql, params)
+            if commit:
+                conn.commit()
+            return cursor
+        except sqlite3.Error as e:
+            conn.rollback()
+            raise StorageError(str(e)) from e
+
+    def _fetchone(self, sql: str, params=()) -> Optional[dict]:
+        row = self._execute(sql, params, commit=False).fetchone()
+        return dict(row) if row else None
+
+    def _fetchall(self, sql: str, params=()) -> list:
+        return [dict(row) for row in self._execute(sql, params, commit=False).fetchall()]
+
+    def _update(self, table: str, allowed: tuple, row_id, fields: dict) -> None:
+        unknown = set(fields) - set(allowed)
+        if unknown:
+            raise ValueError(f"Unknown {table} fields: {', '.join(sorted(unknown))}")
+        if fields:
+            assignments = ", ".join(f"{name}=?" for name in fields)
+            self._execute(f"UPDATE {table} SET {assignments} WHERE id=?", (*fields.values(), row_id))
+
+    # --- users ---
+    def get_user(self, user_id: int) -> Optional[dict]:
+        return self._fetchone("SELECT * FROM users WHERE id=?", (user_id,))
+
+    def add_user(self, user_id: int, username: Optional[str]) -> None:
+        self._execute("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)", (user_id, username))
+
+    def update_user(self, user_id: int, **fields) -> None:
+        self._update("users", USER_FIELDS[1:], user_id, fields)
+
+    def list_users(self, is_approved: Optional[int] = None) -> list:
+        if is_approved is None:
+            return self._fetchall("SELECT * FROM users ORDER BY id")
+        return self._fetchall("SELECT * FROM users WHERE is_approved=? ORDER BY id", (is_approved,))
+
+    def change_credit(self, user_id: int, amount: int) -> bool:
+        return self._execute("UPDATE users SET credit = credit + ? WHERE id=?", (amount, user_id)).rowcount == 1
+
+    # --- codes ---
+    def get_code_value(self, code: str) -> Optional[int]:
+        row = self._fetchone("SELECT value FROM codes WHERE code=?", (code,))
+        return row["value"] if row else None
+
+    def add_code(self, code: str, value: int) -> None:
+        self._execute("INSERT OR REPLACE INTO codes (code, value) VALUES (?, ?)", (code, value))
+
+    def remove_code(self, code: str) -> bool:
+        return self._execute("DELETE FROM codes WHERE code=?", (code,)).rowcount == 1
+
+    def redeem_discount_code(self, user_id: int, code: str) -> int:
+        conn = self.conn
+        try:
+            # Use a transaction for atomicity; both statements must hit exactly one row
+            # or the code/discount was already consumed by a concurrent request.
+            row = conn.execute("SELECT value FROM codes WHERE code=?", (code,)).fetchone()
+            if row is None or conn.execute("DELETE FROM codes WHERE code=?", (code,)).rowcount != 1:
+                conn.rollback()
+                raise InvalidDiscountCode(code)
+            value = row["value"]
+            cursor = conn.execute(
+                "UPDATE users SET credit = credit + ?, discount_used = 1 WHERE id=? AND discount_used=0",
+                (value, user_id)
+            )
+            if cursor.rowcount != 1:
+                conn.rollback()
+                if conn.execute("SELECT 1 FROM users WHERE id=?", (user_id,)).fetchone() is None:
+                    raise StorageError(f"Unknown user {user_id}")
+                raise DiscountAlreadyUsed(user_id)
+            conn.commit()
+            return value
+        except sqlite3.Error as e:
+            conn.rollback()
+            raise StorageError(str(e)) from e
+
+    # --- services ---
+    def list_services(self) -> list:
+        return self._fetchall("SELECT * FROM services")
+
+    def get_service(self, service_type: str) -> Optional[dict]:
+        return self._fetchone("SELECT * FROM services WHERE type=?", (service_type,))
+
+    def set_service(self, service_type: str, content: Optional[str] = None, is_file: int = 0, price: int = 0) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO services (type, content, is_file, price) VALUES (?, ?, ?, ?)",
+            (service_type, content, is_file, price)
+        )
+
+    # --- support_messages ---
+    def add_support_message(self, user_id: int, message: str, timestamp: str) -> int:
+        return self._execute(
+            "INSERT INTO support_messages (user_id, message, timestamp) VALUES (?, ?, ?)",
+            (user_id, message, timestamp)
+        ).lastrowid
+
+    def list_support_messages(self) -> list:
+        return self._fetchall("SELECT * FROM support_messages ORDER BY id")
+
+    # --- purchase_requests ---
+    def add_purchase_request(self, user_id: int, amount: int, description: str, timestamp: str) -> int:
+        return self._execute(
+            "INSERT INTO purchase_requests (user_id, amount, description, timestamp) VALUES (?, ?, ?, ?)",
+            (user_id, amount, description, timestamp)
+        ).lastrowid
+
+    def list_purchase_requests(self, status: Optional[str] = "pending") -> list:
+        if status is None:
+            return self._fetchall("SELECT * FROM purchase_requests ORDER BY id")
+        return self._fetchall("SELECT * FROM purchase_requests WHERE status=? ORDER BY id", (status,))
+
+    def set_purchase_request_status(self, request_id: int, status: str) -> bool:
+        return self._execute(
+            "UPDATE purchase_requests SET status=? WHERE id=?", (status, request_id)
+        ).rowcount == 1
+
+    # --- subscriptions ---
+    def get_subscription(self, subscription_id: int) -> Optional[dict]:
+        return self._fetchone("SELECT * FROM subscriptions WHERE id=?", (subscription_id,))
+
+    def get_active_subscription(self, user_id: int, service_type: str) -> Optional[dict]:
+        return self._fetchone(
+            "SELECT * FROM subscriptions WHERE user_id=? AND service_type=? AND status='active'",
+            (user_id, service_type)
+        )
+
+    def add_subscription(self, user_id: int, service_type: str, started_at: int, expires_at: int, quota: Optional[int]) -> int:
+        return self._execute(
+            "INSERT INTO subscriptions (user_id, service_type, started_at, expires_at, quota) VALUES (?, ?, ?, ?, ?)",
+            (user_id, service_type, started_at, expires_at, quota)
+        ).lastrowid
+
+    def update_subscription(self, subscription_id: int, **fields) -> None:
+        self._update("subscriptions", SUBSCRIPTION_FIELDS[1:], subscription_id, fields)
+
+    def list_active_subscriptions(self, user_id: Optional[int] = None) -> list:
+        # Served by idx_subscriptions_status_expiry / idx_subscriptions_user
+        if user_id is None:
+            return self._fetchall("SELECT * FROM subscriptions WHERE status='active' ORDER BY expires_at")
+        return self._fetchall(
+            "SELECT * FROM subscriptions WHERE user_id=? AND status='active' ORDER BY expires_at",
+            (user_id,)
+        )
+
+
+class MemoryStorage(Storage):
+    """Pure in-memory backend for tests and benchmarks. Nothing survives a restart."""
+
+    def __init__(self):
+        self.users = {}
+        self.codes = {}
+        self.services = {}
+        self.support_messages = {}
+        self.purchase_requests = {}
+        self.subscriptions = {}
+        self._next_id = {"support_messages": 1, "purchase_requests": 1, "subscriptions": 1}
+
+    def _new_id(self, table: str) -> int:
+        row_id = self._next_id[table]
+        self._next_id[table] += 1
+        return row_id
+
+    @staticmethod
+    def _update(rows: dict, allowed: tuple, row_id, fields: dict) -> None:
+        unknown = set(fields) - set(allowed)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        if row_id in rows:
+            rows[row_id].update(fields)
+
+    # --- users ---
+    def get_user(self, user_id: int) -> Optional[dict]:
+        user = self.users.get(user_id)
+        return dict(user) if user else None
+
+    def add_user(self, user_id: int, username: Optional[str]) -> None:
+        if user_id not in self.users:
+            self.users[user_id] = {
+                "id": user_id, "username": username, "credit": 0, "discount_used": 0, "is_approved": 0,
+                "phone_number": None, "full_name": None, "device_type": None
+            }
+
+    def update_user(self, user_id: int, **fields) -> None:
+        self._update(self.users, USER_FIELDS[1:], user_id, fields)
+
+    def list_users(self, is_approved: Optional[int] = None) -> list:
+        return [
+            dict(user) for _, user in sorted(self.users.items())
+            if is_approved is None or user["is_approved"] == is_approved
+        ]
+
+    def change_credit(self, user_id: int, amount: int) -> bool:
+        user = self.users.get(user_id)
+        if user is None:
+            return False
+        user["credit"] += amount
+        return True
+
+    # --- codes ---
+    def get_code_value(self, code: str) -> Optional[int]:
+        return self.codes.get(code)
+
+    def add_code(self, code: str, value: int) -> None:
+        self.codes[code] = value
+
+    def remove_code(self, code: str) -> bool:
+        return self.codes.pop(code, None) is not None
+
+    def redeem_discount_code(self, user_id: int, code: str) -> int:
+        if code not in self.codes:
+            raise InvalidDiscountCode(code)
+        user = self.users.get(user_id)
+        if user is None:
+            raise StorageError(f"Unknown user {user_id}")
+        if user["discount_used"]:
+            raise DiscountAlreadyUsed(user_id)
+        value = self.codes.pop(code)
+        user["credit"] += value
+        user["discount_used"] = 1
+        return value
+
+    # --- services ---
+    def list_services(self) -> list:
+        return [dict(service) for service in self.services.values()]
+
+    def get_service(self, service_type: str) -> Optional[dict]:
+        service = self.services.get(service_type)
+        return dict(service) if service else None
+
+    def set_service(self, service_type: str, content: Optional[str] = None, is_file: int = 0, price: int = 0) -> None:
+        self.services[service_type] = {"type": service_type, "content": content, "is_file": is_file, "price": price}
+
+    # --- support_messages ---
+    def add_support_message(self, user_id: int, message: str, timestamp: str) -> int:
+        message_id = self._new_id("support_messages")
+        self.support_messages[message_id] = {
+            "id": message_id, "user_id": user_id, "message": message, "timestamp": timestamp
+        }
+        return message_id
+
+    def list_support_messages(self) -> list:
+        return [dict(message) for message in self.support_messages.values()]
+
+    # --- purchase_requests ---
+    def add_purchase_request(self, user_id: int, amount: int, description: str, timestamp: str) -> int:
+        request_id = self._new_id("purchase_requests")
+        self.purchase_requests[request_id] = {
+            "id": request_id, "user_id": user_id, "amount": amount, "description": description,
+            "timestamp": timestamp, "status": "pending"
+        }
+        return request_id
+
+    def list_purchase_requests(self, status: Optional[str] = "pending") -> list:
+        return [
+            dict(request) for request in self.purchase_requests.values()
+            if status is None or request["status"] == status
+        ]
+
+    def set_purchase_request_status(self, request_id: int, status: str) -> bool:
+        request = self.purchase_requests.get(request_id)
+        if request is None:
+            return False
+        request["status"] = status
+        return True
+
+    # --- subscriptions ---
+    def get_subscription(self, subscription_id: int) -> Optional[dict]:
+        subscription = self.subscriptions.get(subscription_id)
+        return dict(subscription) if subscription else None
+
+    def get_active_subscription(self, user_id: int, service_type: str) -> Optional[dict]:
+        for subscription in self.subscriptions.values():
+            if (subscription["user_id"] == user_id and subscription["service_type"] == service_type
+                    and subscription["status"] == "active"):
+                return dict(subscription)
+        return None
+
+    def add_subscription(self, user_id: int, service_type: str, started_at: int, expires_at: int, quota: Optional[int]) -> int:
+        subscription_id = self._new_id("subscriptions")
+        self.subscriptions[subscription_id] = {
+            "id": subscription_id, "user_id": user_id, "service_type": service_type, "started_at": started_at,
+            "expires_at": expires_at, "quota": quota, "reminder_sent": 0, "status": "active"
+        }
+        return subscription_id
+
+    def update_subscription(self, subscription_id: int, **fields) -> None:
+        self._update(self.subscriptions, SUBSCRIPTION_FIELDS[1:], subscription_id, fields)
+
+    def list_active_subscriptions(self, user_id: Optional[int] = None) -> list:
+        return sorted(
+            (
+                dict(subscription) for subscription in self.subscriptions.values()
+                if subscription["status"] == "active" and (user_id is None or subscription["user_id"] == user_id)
+            ),
+            key=lambda subscription: subscription["expires_at"]
+        )
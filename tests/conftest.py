@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# main.py and storage.py live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage, SQLiteStorage
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def storage(request):
+    """An empty backend; tests run once against SQLite and once in memory."""
+    backend = SQLiteStorage(":memory:") if request.param == "sqlite" else MemoryStorage()
+    yield backend
+    backend.close()
+
+
+@pytest.fixture
+def fresh_guards(monkeypatch):
+    """Fresh idempotency caches, user locks and metrics, so tests do not see each other's update ids."""
+    import main
+
+    monkeypatch.setattr(main, "processed_updates", main.IdempotencyCache(main.PROCESSED_UPDATES_SIZE, main.PROCESSED_UPDATES_TTL))
+    monkeypatch.setattr(main, "recent_taps", main.IdempotencyCache(main.PROCESSED_UPDATES_SIZE, main.DOUBLE_TAP_WINDOW))
+    monkeypatch.setattr(main, "user_locks", main.UserLockRegistry())
+    monkeypatch.setattr(main, "metrics", main.Counter())
+    monkeypatch.setattr(main, "render_cache", main.OrderedDict())
@@ -0,0 +1,148 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import TelegramError
+
+import main
+
+USERS = 50
+UPDATES = 5000
+CODES_PER_USER = 3
+CODE_VALUE = 100
+
+pytestmark = pytest.mark.usefixtures("fresh_guards")
+
+
+async def _noop(*args, **kwargs):
+    await asyncio.sleep(0) # Yield like a real API call so handlers overlap
+
+
+def make_update(update_id: int, user_id: int, text: str = ""):
+    message = SimpleNamespace(text=text, reply_text=_noop)
+    return SimpleNamespace(
+        update_id=update_id,
+        effective_user=SimpleNamespace(id=user_id),
+        message=message,
+        callback_query=None,
+    )
+
+
+@pytest.fixture
+def seeded_storage(storage):
+    for user_id in range(1, USERS + 1):
+        storage.add_user(user_id, f"user{user_id}")
+        for n in range(CODES_PER_USER):
+            storage.add_code(f"CODE{n}_{user_id}", CODE_VALUE)
+    return storage
+
+
+def test_apply_discount_credits_once_under_duplicate_updates(seeded_storage):
+    context = SimpleNamespace(bot_data={"storage": seeded_storage}, bot=SimpleNamespace(send_message=_noop))
+    updates = []
+    for i in range(UPDATES):
+        user_id = i % USERS + 1
+        # Only 500 distinct update ids, so most deliveries are duplicates; the distinct
+        # ones race each other with different codes for the same user.
+        update_id = i % 500
+        code = f"CODE{update_id // USERS % CODES_PER_USER}_{user_id}"
+        updates.append(make_update(update_id, user_id, code))
+
+    async def run():
+        await asyncio.gather(*(main.apply_discount(update, context) for update in updates))
+
+    asyncio.run(run())
+
+    for user in seeded_storage.list_users():
+        assert user["credit"] == CODE_VALUE
+        assert user["discount_used"] == 1
+    assert main.metrics["duplicate_updates_dropped"] == UPDATES - 500
+    assert len(main.user_locks) == 0
+
+
+def read_modify_write_handler():
+    """A handler with a read-await-write race on a shared balance, like an unguarded transfer."""
+    balance = {"credit": 0}
+
+    async def handler(update, context):
+        credit = balance["credit"]
+        await asyncio.sleep(0)
+        balance["credit"] = credit + 1
+
+    return balance, handler
+
+
+def run_updates(handler, updates) -> None:
+    async def run():
+        await asyncio.gather(*(handler(update, None) for update in updates))
+
+    asyncio.run(run())
+
+
+def test_user_lock_serialises_distinct_updates():
+    distinct = 200
+    balance, handler = read_modify_write_handler()
+    # Every update is delivered three times
+    updates = [make_update(update_id, user_id=1) for update_id in range(distinct) for _ in range(3)]
+
+    run_updates(main.money_action(handler), updates)
+
+    assert balance["credit"] == distinct
+    assert main.metrics["duplicate_updates_dropped"] == 2 * distinct
+    assert len(main.user_locks) == 0
+
+
+def test_unguarded_handler_loses_updates():
+    # Control for the test above: without money_action the race really happens
+    balance, handler = read_modify_write_handler()
+    run_updates(handler, [make_update(update_id, user_id=1) for update_id in range(200)])
+    assert balance["credit"] < 200
+
+
+class FakeBot:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise TelegramError("Timed out")
+        self.sent.append((chat_id, text))
+
+
+def make_tap(query_id: str, message):
+    user = SimpleNamespace(id=7, username="alice")
+    query = SimpleNamespace(id=query_id, from_user=user, data="request_service_V2Ray", message=message, answer=_noop)
+    return SimpleNamespace(update_id=hash(query_id), effective_user=user, callback_query=query, message=None)
+
+
+def make_service_message():
+    return SimpleNamespace(chat_id=7, message_id=1, edit_text=_noop)
+
+
+def test_double_tap_sends_one_service_request():
+    bot = FakeBot()
+    context = SimpleNamespace(bot=bot, bot_data={})
+    message = make_service_message()
+
+    run_updates(
+        lambda update, _: main.send_service_request_to_admin(update, context),
+        [make_tap("tap-1", message), make_tap("tap-2", message)]
+    )
+
+    assert len(bot.sent) == 1
+    assert main.metrics["duplicate_taps_dropped"] == 1
+
+
+def test_failed_service_request_can_be_retried():
+    bot = FakeBot(failures=1)
+    context = SimpleNamespace(bot=bot, bot_data={})
+    message = make_service_message()
+
+    with pytest.raises(TelegramError):
+        asyncio.run(main.send_service_request_to_admin(make_tap("tap-1", message), context))
+    asyncio.run(main.send_service_request_to_admin(make_tap("tap-2", message), context))
+
+    assert len(bot.sent) == 1
+    assert main.metrics["duplicate_taps_dropped"] == 0
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+import main
+
+
+class FakeMessage:
+    def __init__(self, message_id: int = 1, chat_id: int = 100, error: Exception = None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.error = error
+        self.edits = []
+
+    async def edit_text(self, text, reply_markup=None, parse_mode=None):
+        self.edits.append((text, reply_markup, parse_mode))
+        if self.error is not None:
+            raise self.error
+
+
+def keyboard(callback_data: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("منوی اصلی", callback_data=callback_data)]])
+
+
+def edit(message, text, reply_markup=None, parse_mode=None):
+    return asyncio.run(main.edit_message(message, text, reply_markup=reply_markup, parse_mode=parse_mode))
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(main, "render_cache", main.OrderedDict())
+    monkeypatch.setattr(main, "metrics", main.Counter())
+
+
+def test_identical_edit_is_skipped():
+    message = FakeMessage()
+    edit(message, "منوی اصلی:", keyboard("main_menu"))
+    # A freshly built but equal markup must still hit the cache
+    edit(message, "منوی اصلی:", keyboard("main_menu"))
+
+    assert len(message.edits) == 1
+    assert main.metrics["render_cache_hits"] == 1
+    assert main.metrics["render_cache_misses"] == 1
+
+
+def test_changed_markup_or_parse_mode_calls_api():
+    message = FakeMessage()
+    edit(message, "منوی اصلی:", keyboard("main_menu"))
+    edit(message, "منوی اصلی:", keyboard("admin_panel"))
+    edit(message, "منوی اصلی:", keyboard("admin_panel"), parse_mode="Markdown")
+    edit(message, "منوی اصلی:")
+
+    assert len(message.edits) == 4
+    assert main.metrics["render_cache_hits"] == 0
+
+
+def test_not_modified_error_is_swallowed_and_cached():
+    message = FakeMessage(error=BadRequest("Message is not modified: specified new message content is the same"))
+    assert edit(message, "text") is None
+    message.error = None
+    edit(message, "text")
+
+    assert len(message.edits) == 1
+    assert main.metrics["render_cache_hits"] == 1
+
+
+def test_other_bad_request_is_raised_and_not_cached():
+    message = FakeMessage(error=BadRequest("Message to edit not found"))
+    with pytest.raises(BadRequest):
+        edit(message, "text")
+    assert (message.chat_id, message.message_id) not in main.render_cache
+
+    message.error = None
+    edit(message, "text")
+    assert len(message.edits) == 2
+
+
+def test_oldest_entry_is_evicted(monkeypatch):
+    monkeypatch.setattr(main, "RENDER_CACHE_SIZE", 2)
+    first, second, third = FakeMessage(1), FakeMessage(2), FakeMessage(3)
+    edit(first, "text")
+    edit(second, "text")
+    edit(first, "text") # Hit: first becomes the most recently used entry
+    edit(third, "text")
+
+    assert list(main.render_cache) == [(100, 1), (100, 3)]
+    edit(second, "text")
+    assert len(second.edits) == 2
+    assert len(first.edits) == 1
@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from storage import MemoryStorage
+
+DAY = 24 * 3600
+ADMIN = 42
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    def messages_to(self, chat_id) -> list:
+        return [text for target, text in self.sent if target == chat_id]
+
+
+@pytest.fixture
+def storage():
+    backend = MemoryStorage()
+    backend.add_user(1, "alice")
+    backend.set_service("V2Ray", price=100)
+    return backend
+
+
+@pytest.fixture
+def scheduler(monkeypatch, fresh_guards):
+    scheduler = main.ExpiryScheduler()
+    monkeypatch.setattr(main, "expiry_scheduler", scheduler)
+    monkeypatch.setattr(main, "ADMIN_ID", ADMIN)
+    return scheduler
+
+
+def run_scheduler(scheduler, storage, bot, seconds: float = 0.05) -> None:
+    async def run():
+        scheduler.start(bot, storage)
+        await asyncio.sleep(seconds)
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+
+def drain(scheduler) -> list:
+    heap = list(scheduler._heap)
+    return [heapq.heappop(heap) for _ in range(len(heap))]
+
+
+def test_heap_pops_in_due_order(storage, scheduler):
+    now = int(time.time())
+    for days in (30, 10, 20):
+        storage.add_subscription(1, "V2Ray", now, now + days * DAY, None)
+    scheduler.load(storage)
+
+    reminder_days = main.SUBSCRIPTION_REMINDER_SECONDS // DAY
+    assert [(entry[1], (entry[0] - now) // DAY) for entry in drain(scheduler)] == [
+        ("remind", 10 - reminder_days), ("expire", 10),
+        ("remind", 20 - reminder_days), ("expire", 20),
+        ("remind", 30 - reminder_days), ("expire", 30),
+    ]
+
+
+def test_renewal_leaves_stale_entries_that_are_skipped(storage, scheduler):
+    now = int(time.time())
+    subscription_id = storage.add_subscription(1, "V2Ray", now - 10, now - 1, None)
+    storage.update_subscription(subscription_id, reminder_sent=1)
+    scheduler.load(storage)
+
+    # Renewing pushes fresh entries; the old, already-due expiry entry stays in the heap
+    expires_at = main.add_or_renew_subscription(storage, 1, "V2Ray", 30)
+    assert len(scheduler._heap) == 3
+
+    bot = FakeBot()
+    run_scheduler(scheduler, storage, bot)
+
+    assert bot.sent == []
+    subscription = storage.get_subscription(subscription_id)
+    assert subscription["status"] == "active"
+    assert subscription["expires_at"] == expires_at
+    assert [entry[3] for entry in drain(scheduler)] == [expires_at, expires_at]
+
+
+def test_short_subscription_gets_no_reminder(storage, scheduler):
+    main.add_or_renew_subscription(storage, 1, "V2Ray", 1)
+    assert main.SUBSCRIPTION_REMINDER_SECONDS > DAY
+    assert [entry[1] for entry in drain(scheduler)] == ["expire"]
+
+
+def test_missed_reminder_fires_after_load(storage, scheduler):
+    now = int(time.time())
+    # The reminder was due an hour ago, while the bot was offline
+    expires_at = now + main.SUBSCRIPTION_REMINDER_SECONDS - 3600
+    subscription_id = storage.add_subscription(1, "V2Ray", now - DAY, expires_at, None)
+    scheduler.load(storage)
+    assert [entry[1] for entry in drain(scheduler)] == ["remind", "expire"]
+
+    bot = FakeBot()
+    run_scheduler(scheduler, storage, bot)
+
+    assert len(bot.messages_to(1)) == 1
+    assert storage.get_subscription(subscription_id)["reminder_sent"] == 1
+    assert [entry[1] for entry in drain(scheduler)] == ["expire"]
+
+    # Reloading after a restart does not remind again
+    scheduler.load(storage)
+    assert [entry[1] for entry in drain(scheduler)] == ["expire"]
+
+
+def test_expiry_marks_subscription_expired_and_notifies_once(storage, scheduler):
+    now = int(time.time())
+    subscription_id = storage.add_subscription(1, "V2Ray", now - DAY, now - 1, None)
+    storage.update_subscription(subscription_id, reminder_sent=1)
+    scheduler.load(storage)
+
+    bot = FakeBot()
+    run_scheduler(scheduler, storage, bot)
+
+    assert storage.get_subscription(subscription_id)["status"] == "expired"
+    assert len(bot.messages_to(1)) == 1
+    assert len(bot.messages_to(ADMIN)) == 1
+    assert scheduler._heap == []
+
+    scheduler.load(storage)
+    assert scheduler._heap == []
+
+
+@pytest.mark.parametrize("args", [
+    ["1", "V2Ray", "0"],
+    ["1", "V2Ray", "-5"],
+    ["1", "V2Ray", "30", "-1"],
+])
+def test_addsub_rejects_invalid_values(storage, scheduler, args):
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    update = SimpleNamespace(
+        update_id=hash(tuple(args)),
+        effective_user=SimpleNamespace(id=ADMIN),
+        message=SimpleNamespace(reply_text=reply_text),
+        callback_query=None,
+    )
+    context = SimpleNamespace(args=args, bot_data={"storage": storage}, bot=FakeBot())
+
+    asyncio.run(main.admin_add_subscription(update, context))
+
+    assert replies == ["❌ مقادیر وارد شده معتبر نیست."]
+    assert storage.list_active_subscriptions() == []
+    assert scheduler._heap == []
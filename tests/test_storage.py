@@ -0,0 +1,145 @@
+import sqlite3
+
+import pytest
+
+from storage import (
+    Storage, SQLiteStorage, MemoryStorage,
+    StorageError, InvalidDiscountCode, DiscountAlreadyUsed
+)
+
+
+def run_scenario(storage: Storage) -> list:
+    """Drive every interface method and collect the results, so backends can be compared."""
+    results = []
+    storage.add_user(1, "alice")
+    storage.add_user(1, "ignored")
+    storage.add_user(2, "bob")
+    storage.update_user(1, full_name="Alice", is_approved=1)
+    results.append(storage.get_user(1))
+    results.append(storage.get_user(3))
+    results.append(storage.list_users())
+    results.append(storage.list_users(is_approved=0))
+    results.append((storage.change_credit(2, 50), storage.change_credit(2, -20), storage.change_credit(3, 10)))
+
+    storage.add_code("A", 100)
+    storage.add_code("B", 200)
+    storage.add_code("C", 300)
+    results.append((storage.get_code_value("A"), storage.get_code_value("missing")))
+    results.append((storage.remove_code("C"), storage.remove_code("C")))
+
+    storage.set_service("V2Ray", content="vless://", price=150)
+    storage.set_service("Proxy", is_file=1)
+    storage.set_service("V2Ray", content="vless://new", price=200)
+    results.append(sorted(storage.list_services(), key=lambda service: service["type"]))
+    results.append((storage.get_service("V2Ray"), storage.get_service("missing")))
+
+    results.append(storage.add_support_message(1, "hi", "2026-01-01"))
+    results.append(storage.add_support_message(2, "hello", "2026-01-02"))
+    results.append(storage.list_support_messages())
+
+    results.append(storage.add_purchase_request(1, 1000, "card", "2026-01-01"))
+    results.append(storage.add_purchase_request(2, 2000, "card", "2026-01-02"))
+    results.append((storage.set_purchase_request_status(1, "approved"), storage.set_purchase_request_status(9, "approved")))
+    results.append(storage.list_purchase_requests())
+    results.append(storage.list_purchase_requests(None))
+
+    late = storage.add_subscription(1, "V2Ray", 0, 300, None)
+    early = storage.add_subscription(2, "V2Ray", 0, 100, 50)
+    middle = storage.add_subscription(1, "Proxy", 0, 200, 10)
+    storage.update_subscription(middle, reminder_sent=1)
+    results.append([sub["id"] for sub in storage.list_active_subscriptions()])
+    results.append([sub["id"] for sub in storage.list_active_subscriptions(1)])
+    storage.update_subscription(early, status="expired")
+    results.append((storage.get_active_subscription(2, "V2Ray"), storage.get_active_subscription(1, "V2Ray")))
+    results.append((storage.get_subscription(late), storage.get_subscription(99)))
+    return results
+
+
+def test_backends_agree():
+    sqlite_storage = SQLiteStorage(":memory:")
+    try:
+        assert run_scenario(sqlite_storage) == run_scenario(MemoryStorage())
+    finally:
+        sqlite_storage.close()
+
+
+def test_redeem_discount_code(storage):
+    storage.add_user(1, "alice")
+    storage.add_code("A", 100)
+    storage.add_code("B", 200)
+
+    assert storage.redeem_discount_code(1, "A") == 100
+    assert storage.get_user(1)["credit"] == 100
+    assert storage.get_user(1)["discount_used"] == 1
+    assert storage.get_code_value("A") is None
+
+    with pytest.raises(InvalidDiscountCode):
+        storage.redeem_discount_code(1, "A")
+    with pytest.raises(DiscountAlreadyUsed):
+        storage.redeem_discount_code(1, "B")
+    # A failed redemption must not consume the code or change credit
+    assert storage.get_code_value("B") == 200
+    assert storage.get_user(1)["credit"] == 100
+
+    with pytest.raises(StorageError):
+        storage.redeem_discount_code(2, "B")
+    assert storage.get_code_value("B") == 200
+
+
+def test_update_with_unknown_fields(storage):
+    storage.add_user(1, "alice")
+    with pytest.raises(ValueError):
+        storage.update_user(1, credit=5, is_admin=1)
+    with pytest.raises(ValueError):
+        storage.update_user(1, id=2)
+    assert storage.get_user(1)["credit"] == 0
+
+    subscription_id = storage.add_subscription(1, "V2Ray", 0, 100, None)
+    with pytest.raises(ValueError):
+        storage.update_subscription(subscription_id, expires=200)
+
+
+def test_subscriptions_ordered_by_expiry(storage):
+    for user_id, expires_at in [(1, 500), (2, 100), (1, 300), (3, 200)]:
+        storage.add_subscription(user_id, f"service{expires_at}", 0, expires_at, None)
+
+    assert [sub["expires_at"] for sub in storage.list_active_subscriptions()] == [100, 200, 300, 500]
+    assert [sub["expires_at"] for sub in storage.list_active_subscriptions(1)] == [300, 500]
+
+
+def test_incomplete_backend_cannot_be_created():
+    class PartialStorage(Storage):
+        def get_user(self, user_id):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialStorage()
+
+
+def test_sqlite_connect_failure_raises_storage_error(tmp_path):
+    # A directory cannot be opened as a database file
+    storage = SQLiteStorage(str(tmp_path))
+    with pytest.raises(StorageError):
+        storage.get_user(1)
+    assert storage._conn is None
+
+
+def test_sqlite_failed_schema_setup_is_retried(monkeypatch):
+    storage = SQLiteStorage(":memory:")
+    setup_database = SQLiteStorage._setup_database
+    calls = []
+
+    def flaky_setup(self, conn):
+        calls.append(conn)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("disk I/O error")
+        setup_database(self, conn)
+
+    monkeypatch.setattr(SQLiteStorage, "_setup_database", flaky_setup)
+    with pytest.raises(StorageError):
+        storage.add_user(1, "alice")
+    assert storage._conn is None
+
+    storage.add_user(1, "alice")
+    assert storage.get_user(1)["username"] == "alice"
+    storage.close()